@@ -2,6 +2,8 @@
 import os
 # For checking how long it takes to run tests
 import time
+# For queueing inputs to interactive sessions
+from collections import deque
 
 # Test if the following behaviours are the same in batch process mode as regular user mode:
 # 1. Automatically reset program counter after HLT instruction
@@ -49,6 +51,22 @@ TEST_LOGGING_CUTOFF = 100
 TEST_LARGE_NUMBER = 1_000
 TEST_LOG_FREQUENCY = 100
 
+# At or above N tests, tests will be split into shards and run in parallel (see runSpeculativeTestMode)
+TEST_SPECULATIVE_CUTOFF = 10_000
+# Only count the cores this process is allowed to use (e.g. inside a container), where we can tell
+TEST_SPECULATIVE_SHARDS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+# Tracking what each shard depends on makes it ~1.5x slower than running the same tests serially,
+# so only run in parallel with enough cores to make up for it
+TEST_SPECULATIVE_MIN_SHARDS = 4
+# A speculative shard gives up on a test after this many times the largest maxCycles of any test
+# (the guessed starting state could make the program loop forever), and is re-run serially instead
+TEST_SPECULATIVE_CYCLE_FACTOR = 10
+
+# How many F-E cycles a session gets each time it's resumed before yielding to the next session (see runSessions)
+SESSION_STEP_BUDGET = 1_000
+# How many turns each session gets per call to runSessions, so one program stuck in an infinite loop can't stop it returning
+SESSION_MAX_ROUNDS = 100
+
 def splitByWhitespace(string : str) -> list:
     """
     Split a string by any whitespace character
@@ -506,6 +524,39 @@ def softResetProgram(state : ProgramState) -> None:
     # Jumps back to start of program
     state.programCounter = 0
 
+def logTestResult(testIndex : int, currentTest : Test, cycles : int, outputs : list, disableLogging : bool) -> bool:
+    """
+    Print the result of a single test, returning True if it passed
+    """
+    testSucceeded = len(outputs) == 1 and outputs[0] == currentTest.expectedOutput
+
+    if testSucceeded:
+        if not disableLogging:
+            print(f"Test {testIndex + 1}: '{currentTest.name}' passed in {cycles} F-E cycles")
+    else:
+        reason = None
+
+        if cycles > currentTest.maxCycles:
+            reason = f"Exceeded maximum instructions {currentTest.maxCycles}"
+
+        else:
+            output = None if len(outputs) < 1 else outputs
+            reason = f"For input {currentTest.givenInputs} expected {currentTest.expectedOutput}, but got {output} instead"
+
+        print(f"Test {testIndex + 1}: '{currentTest.name}' failed -> {reason}")
+
+    return testSucceeded
+
+def logTestSummary(tests : list, passedTestCounter : int, totalCycles : int, maxCycles : int, maxCyclesInput : list, timeElapsedNanoseconds : int) -> None:
+    """
+    Print the summary after running all tests
+    """
+    cyclesPerSecond = totalCycles / (timeElapsedNanoseconds * 1E-6)
+
+    print(f"{passedTestCounter}/{len(tests)} passed in {timeElapsedNanoseconds * 1E-9:.3g}s")
+    print(f"Worst case cycles: {maxCycles} for input {maxCyclesInput}")
+    print(f"Average of {int(totalCycles/len(tests))} cycles, at speed {cyclesPerSecond:.4g} cycles per millisecond")
+
 def runTestMode(tests : list, state : ProgramState) -> None:
     """
     Runs your program in testing mode
@@ -539,37 +590,417 @@ def runTestMode(tests : list, state : ProgramState) -> None:
             maxCycles = cycles
             maxCyclesInput = currentTest.givenInputs
 
-        testSucceeded = len(state.outputs) == 1 and state.outputs[0] == tests[testIndex].expectedOutput
-        
         if doProgressUpdates and (testIndex % TEST_LOG_FREQUENCY == 0):
             print(f"Completed {testIndex} tests")
 
-        if testSucceeded:
+        if logTestResult(testIndex, currentTest, cycles, state.outputs, disableLogging):
             passedTestCounter += 1
 
-            if not disableLogging:
-                print(f"Test {testIndex + 1}: '{currentTest.name}' passed in {cycles} F-E cycles")
-        else:
-            reason = None
+        softResetProgram(state)
 
-            if cycles > currentTest.maxCycles:
-                reason = f"Exceeded maximum instructions {currentTest.maxCycles}"
+    end = time.time_ns()
 
-            else:
-                output = None if len(state.outputs) < 1 else state.outputs
-                reason = f"For input {currentTest.givenInputs} expected {currentTest.expectedOutput}, but got {output} instead"
+    logTestSummary(tests, passedTestCounter, totalCycles, maxCycles, maxCyclesInput, end - start)
+
+class SpeculativeShard(object):
+    """
+    Struct to hold what a shard of tests did to, and depended on from, its guessed starting state
+
+    If the real starting state matches the guessed one on everything that was read before being written to,
+    the shard would've behaved exactly the same from the real starting state
+
+    accumulator: Value in calculator after the last test
+    negativeFlag: Negative flag after the last test
+    memory: Memory after the last test
+    reads: Mailboxes that were read before being written to
+    touched: Mailboxes that were read or written to
+    accumulatorRead: Accumulator was read before being written to
+    accumulatorTouched: Accumulator was read or written to
+    negativeFlagRead: Negative flag was read before being written to
+    negativeFlagTouched: Negative flag was read or written to
+    """
+    def __init__(self):
+        self.accumulator = 0
+        self.negativeFlag = False
+        self.memory = None
 
-            print(f"Test {testIndex + 1}: '{currentTest.name}' failed -> {reason}")
+        self.reads = set()
+        self.touched = set()
+
+        self.accumulatorRead = False
+        self.accumulatorTouched = False
+        self.negativeFlagRead = False
+        self.negativeFlagTouched = False
+
+def speculativeRunShard(tests : list, accumulator : int, negativeFlag : bool, memory : list, maxCycles : int) -> tuple:
+    """
+    Run a shard of tests back to back from a guessed starting state, carrying state between tests like runTestMode
+
+    Runs in a worker process, returns (results, shard) where results is a list of (cycles, outputs) for each test,
+    and shard is a SpeculativeShard, or None if the shard raised an error or ran for more than maxCycles on a
+    single test (the shard then has to be re-run serially)
+    """
+    state = ProgramState()
+    state.memory = memory
+    state.accumulator = accumulator
+    state.negativeFlag = negativeFlag
+    state.testMode = True
+
+    shard = SpeculativeShard()
+    reads = shard.reads
+    touched = shard.touched
+
+    accumulatorRead = accumulatorTouched = False
+    negativeFlagRead = negativeFlagTouched = False
+
+    results = []
+
+    for currentTest in tests:
+        state.inputs = [currentTest.givenInputs[i] for i in range(len(currentTest.givenInputs) - 1, -1, -1)]
+
+        cycles = 0
+
+        try:
+            # Bounded version of runProgram, since a wrong guess at the starting state could loop forever
+            while not state.haltFlag:
+                if cycles > maxCycles:
+                    return results, None
+
+                # Only the first access to each part of the state is recorded, everything after that
+                # depends on what the shard itself did, not on the starting state
+                programCounter = state.programCounter
+
+                if programCounter not in touched:
+                    touched.add(programCounter)
+                    reads.add(programCounter)
+
+                instruction = state.memory[programCounter]
+                opcode = instruction // 100
+                address = instruction - opcode * 100
+
+                # ADD, SUB, LDA read a mailbox, STO writes to one
+                if address not in touched and opcode in (1, 2, 3, 5):
+                    touched.add(address)
+
+                    if opcode != 3:
+                        reads.add(address)
+
+                if not accumulatorTouched:
+                    # Only LDA and IN write to the accumulator without reading it first
+                    if opcode == 5 or instruction == IN:
+                        accumulatorTouched = True
+                    elif opcode in (1, 2, 3, 7) or instruction == OUT:
+                        accumulatorTouched = accumulatorRead = True
+
+                if not negativeFlagTouched:
+                    # Only BRP reads the negative flag, it's written by LDA, IN, or a SUB that underflows
+                    if opcode == 8:
+                        negativeFlagTouched = negativeFlagRead = True
+                    elif opcode == 5 or instruction == IN or (opcode == 2 and state.accumulator < state.memory[address]):
+                        negativeFlagTouched = True
+
+                interpreterAdvance(state)
+                cycles += 1
+        except (RuntimeError, IndexError):
+            return results, None
+
+        results.append((cycles, state.outputs))
 
         softResetProgram(state)
 
+    shard.accumulator = state.accumulator
+    shard.negativeFlag = state.negativeFlag
+    shard.memory = state.memory
+    shard.accumulatorRead = accumulatorRead
+    shard.accumulatorTouched = accumulatorTouched
+    shard.negativeFlagRead = negativeFlagRead
+    shard.negativeFlagTouched = negativeFlagTouched
+
+    return results, shard
+
+def speculativeCheckShard(predictedState : tuple, actualState : tuple, shard : SpeculativeShard) -> tuple:
+    """
+    Check a shard's guessed starting state against the real one, returning the real state after the shard,
+    or None if the shard depended on something it guessed wrong
+
+    predictedState and actualState are (accumulator, negativeFlag, memory)
+    """
+    predictedAccumulator, predictedNegativeFlag, predictedMemory = predictedState
+    accumulator, negativeFlag, memory = actualState
+
+    if shard.accumulatorRead and predictedAccumulator != accumulator:
+        return None
+    if shard.negativeFlagRead and predictedNegativeFlag != negativeFlag:
+        return None
+
+    for address in shard.reads:
+        if predictedMemory[address] != memory[address]:
+            return None
+
+    # Anything the shard touched was either written to, or read and so matches the real starting state,
+    # anything else is left as it was in the real starting state
+    exitMemory = list(memory)
+
+    for address in shard.touched:
+        exitMemory[address] = shard.memory[address]
+
+    exitAccumulator = shard.accumulator if shard.accumulatorTouched else accumulator
+    exitNegativeFlag = shard.negativeFlag if shard.negativeFlagTouched else negativeFlag
+
+    return exitAccumulator, exitNegativeFlag, exitMemory
+
+def runSpeculativeTestMode(tests : list, state : ProgramState, shardCount : int = None) -> None:
+    """
+    Runs your program in testing mode, splitting the tests into shards which run in parallel
+
+    Every shard guesses that it starts from the same state as the first test (most programs reset
+    themselves), then the guesses are checked in order against the exit state of the previous shard,
+    only on the parts of the state the shard read before writing to them.
+    Shards that guessed wrong are re-run serially from the real state, so the results are exactly the
+    same as runTestMode
+    """
+    # Import here so user mode doesn't pay for spinning up the process pool machinery
+    from concurrent.futures import ProcessPoolExecutor
+
+    if shardCount is None:
+        shardCount = TEST_SPECULATIVE_SHARDS
+
+    shardCount = max(1, min(shardCount, len(tests)))
+
+    disableLogging = len(tests) >= TEST_LOGGING_CUTOFF
+
+    doProgressUpdates = len(tests) >= TEST_LARGE_NUMBER
+
+    passedTestCounter = 0
+    totalCycles = 0
+    maxCycles = 0
+    maxCyclesInput = []
+    mispredictedShards = 0
+
+    state.testMode = True
+
+    print(f"About to run {len(tests)} tests across {shardCount} shards")
+
+    start = time.time_ns()
+
+    # Split tests into contiguous shards of (almost) equal size
+    shardSize, remainder = divmod(len(tests), shardCount)
+    shards = []
+    shardStart = 0
+
+    for i in range(shardCount):
+        shardEnd = shardStart + shardSize + (1 if i < remainder else 0)
+        shards.append(tests[shardStart:shardEnd])
+        shardStart = shardEnd
+
+    # Predicted entry state of every shard, the state before the first test
+    predictedState = (state.accumulator, state.negativeFlag, list(state.memory))
+    speculationCycles = max(currentTest.maxCycles for currentTest in tests) * TEST_SPECULATIVE_CYCLE_FACTOR
+
+    with ProcessPoolExecutor(max_workers=shardCount) as executor:
+        futures = [executor.submit(speculativeRunShard, shard, *predictedState, speculationCycles) for shard in shards]
+
+        results = []
+        actualState = predictedState
+
+        for shardIndex, (shard, future) in enumerate(zip(shards, futures)):
+            shardResults, speculativeShard = future.result()
+
+            exitState = None if speculativeShard is None else speculativeCheckShard(predictedState, actualState, speculativeShard)
+
+            # Guess was wrong, or speculation gave up, so re-run this shard from the real state
+            if exitState is None:
+                mispredictedShards += 1
+
+                state.accumulator, state.negativeFlag, state.memory = actualState[0], actualState[1], list(actualState[2])
+                shardResults = []
+
+                for currentTest in shard:
+                    state.inputs = [currentTest.givenInputs[i] for i in range(len(currentTest.givenInputs) - 1, -1, -1)]
+                    cycles = runProgram(state)
+                    shardResults.append((cycles, state.outputs))
+                    softResetProgram(state)
+
+                exitState = (state.accumulator, state.negativeFlag, state.memory)
+
+            results.extend(shardResults)
+            actualState = exitState
+
+            if doProgressUpdates:
+                print(f"Completed shard {shardIndex + 1}/{shardCount}")
+
+    # Leave program in the same state the serial run would have
+    state.accumulator, state.negativeFlag, state.memory = actualState[0], actualState[1], list(actualState[2])
+
+    for testIndex, (currentTest, (cycles, outputs)) in enumerate(zip(tests, results)):
+        totalCycles += cycles
+
+        if cycles > maxCycles:
+            maxCycles = cycles
+            maxCyclesInput = currentTest.givenInputs
+
+        if logTestResult(testIndex, currentTest, cycles, outputs, disableLogging):
+            passedTestCounter += 1
+
     end = time.time_ns()
-    timeElapsedNanoseconds = end - start
-    cyclesPerSecond = totalCycles / (timeElapsedNanoseconds * 1E-6)
 
-    print(f"{passedTestCounter}/{len(tests)} passed in {timeElapsedNanoseconds * 1E-9:.3g}s")
-    print(f"Worst case cycles: {maxCycles} for input {maxCyclesInput}")
-    print(f"Average of {int(totalCycles/len(tests))} cycles, at speed {cyclesPerSecond:.4g} cycles per millisecond")
+    print(f"Re-ran {mispredictedShards}/{shardCount} shards serially after a wrong guess at their starting state")
+
+    logTestSummary(tests, passedTestCounter, totalCycles, maxCycles, maxCyclesInput, end - start)
+
+def runProgramCoroutine(state : ProgramState, stepBudget : int = SESSION_STEP_BUDGET):
+    """
+    Executes program to completion as a generator, returning number of F-E cycles
+
+    Instead of blocking on IN/OUT, yields (IN, None) and expects the input to be sent back,
+    or yields (OUT, value) for each output (not stored in state.outputs, it's up to the caller to keep them).
+    Yields (None, None) every stepBudget F-E cycles so many programs can take turns running (see runSessions)
+    """
+    FECycles = 0
+    steps = 0
+
+    while not state.haltFlag:
+        instruction = state.memory[state.programCounter]
+
+        if instruction == IN:
+            state.programCounter += 1
+            value = yield IN, None
+            interpreterSetAccumulator(value, IN, state)
+        elif instruction == OUT:
+            state.programCounter += 1
+            yield OUT, state.accumulator
+        else:
+            interpreterAdvance(state)
+
+        FECycles += 1
+        steps += 1
+
+        if steps >= stepBudget and not state.haltFlag:
+            steps = 0
+            yield None, None
+
+    return FECycles
+
+class Session(object):
+    """
+    Struct to represent one interactive run of a program, many of which can be run at once by runSessions
+
+    state: Program state of this session
+    inputs: Inputs waiting to be read by the program, in the order they were sent (ONLY THE CURRENT RUN)
+    outputs: Outputs of the program, in the order they were made (ONLY THE CURRENT/LAST RUN)
+    coroutine: Generator from runProgramCoroutine, None once the program has halted
+    awaitingInput: Program is stopped on an IN instruction, waiting for an input
+    cycles: Number of F-E cycles the last run took, None while running
+    error: Error which stopped the program, if any
+    stepBudget: F-E cycles the program runs for each time it's resumed, before letting other sessions run
+    """
+    def __init__(self, state : ProgramState, stepBudget : int = SESSION_STEP_BUDGET):
+        self.state = state
+        self.stepBudget = stepBudget
+        self.inputs = deque()
+        self.outputs = []
+        self.coroutine = None
+        self.awaitingInput = False
+        self.cycles = None
+        self.error = None
+
+        sessionStart(self)
+
+def sessionStart(session : Session) -> None:
+    """
+    Start running the session's program, or run it again after it has halted
+
+    If the program is still running, it's stopped and started again from the first mailbox.
+    Queued inputs and previous outputs are thrown away, but like after a HLT, the calculator,
+    negative flag and memory are not reset
+    """
+    # Still running, so throw away the old run and jump back to the start
+    if session.coroutine is not None:
+        session.coroutine.close()
+        softResetProgram(session.state)
+
+    session.inputs.clear()
+    session.outputs = []
+    session.coroutine = runProgramCoroutine(session.state, session.stepBudget)
+    session.awaitingInput = False
+    session.cycles = None
+    session.error = None
+
+def sessionSendInput(session : Session, value : int) -> None:
+    """
+    Queue an input for the session's program to read on its next IN instruction
+    """
+    if not (isinstance(value, int) and 0 <= value <= 999):
+        raise RuntimeError(f"Input must be an integer from 0 to 999, but got {value}")
+
+    session.inputs.append(value)
+
+def sessionIsRunnable(session : Session) -> bool:
+    """
+    Check if resuming the session would make any progress
+    """
+    return session.coroutine is not None and not (session.awaitingInput and len(session.inputs) == 0)
+
+def sessionResume(session : Session) -> None:
+    """
+    Run the session's program until it uses up its step budget, halts, or needs an input it doesn't have yet
+    """
+    if not sessionIsRunnable(session):
+        return
+
+    coroutine = session.coroutine
+
+    try:
+        if session.awaitingInput:
+            value = session.inputs.popleft()
+            session.awaitingInput = False
+            event, value = coroutine.send(value)
+        else:
+            event, value = next(coroutine)
+
+        while event is not None:
+            if event == OUT:
+                session.outputs.append(value)
+                event, value = next(coroutine)
+            elif len(session.inputs) > 0:
+                event, value = coroutine.send(session.inputs.popleft())
+            else:
+                session.awaitingInput = True
+                return
+
+    except StopIteration as stop:
+        session.cycles = stop.value
+        session.coroutine = None
+        softResetProgram(session.state)
+
+    except (RuntimeError, IndexError) as error:
+        # Don't let one broken program stop every other session
+        session.error = error
+        session.coroutine = None
+        softResetProgram(session.state)
+
+def runSessions(sessions : list, maxRounds : int = SESSION_MAX_ROUNDS) -> bool:
+    """
+    Runs many sessions in one process, taking turns (round-robin) so every session gets a fair share of time
+
+    Returns once every session has either halted or is waiting on an input, or after maxRounds turns each.
+    Returns True if any session could still make progress, so call again to continue.
+    Passing maxRounds=None runs until every session halts or waits on an input, which never returns if
+    a program is stuck in an infinite loop
+    """
+    rounds = 0
+    progressed = True
+
+    while progressed and (maxRounds is None or rounds < maxRounds):
+        progressed = False
+        rounds += 1
+
+        for session in sessions:
+            if sessionIsRunnable(session):
+                sessionResume(session)
+                progressed = True
+
+    return any(sessionIsRunnable(session) for session in sessions)
 
 def runUserMode(state : ProgramState) -> None:
     """
@@ -638,7 +1069,9 @@ if __name__ == "__main__":
                 # This line is a warcrime
                 tests.append(Test(name, [int(i) for i in inputs.split(",")], int(output), int(feMax)))
 
-    if len(tests) > 0:
+    if len(tests) >= TEST_SPECULATIVE_CUTOFF and TEST_SPECULATIVE_SHARDS >= TEST_SPECULATIVE_MIN_SHARDS:
+        runSpeculativeTestMode(tests, programState)
+    elif len(tests) > 0:
         runTestMode(tests, programState)
     else:
         runUserMode(programState)